@@ -42,9 +42,7 @@ setup(
         # eg: "aspectlib==1.1.1", "six>=1.7",
     ],
     extras_require={
-        # eg:
-        #   "rst": ["docutils>=0.11"],
-        #   ":python_version=="2.6"": ["argparse"],
+        "bulk": ["numpy"],
     },
     entry_points={
         # eg:
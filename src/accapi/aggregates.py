@@ -0,0 +1,188 @@
+from threading import Lock
+
+__all__ = ["SegmentStats", "SectorAggregator"]
+
+PIT_LOCATIONS = frozenset(("Pitlane", "Pit Entry", "Pit Exit"))
+
+
+class SegmentStats(object):
+    """
+    Running statistics of one car over one track segment.
+
+    Attributes:
+        samples (int): Number of updates received within the segment.
+        minKmh (int): Lowest speed, or None without samples.
+        maxKmh (int): Highest speed, or None without samples.
+        meanKmh (float): Average speed over the updates, or None without samples.
+        pitTimeMs (float): Session time spent in the pit lane within the segment.
+        lastTimeMs (float): Time of the last complete pass through the segment, or None.
+        bestTimeMs (float): Time of the fastest complete pass through the segment, or None.
+        passes (int): Number of complete passes through the segment.
+    """
+
+    __slots__ = (
+        "samples",
+        "minKmh",
+        "maxKmh",
+        "sumKmh",
+        "pitTimeMs",
+        "lastTimeMs",
+        "bestTimeMs",
+        "passes",
+    )
+
+    def __init__(self):
+        self.samples = 0
+        self.minKmh = None
+        self.maxKmh = None
+        self.sumKmh = 0
+        self.pitTimeMs = 0
+        self.lastTimeMs = None
+        self.bestTimeMs = None
+        self.passes = 0
+
+    @property
+    def meanKmh(self):
+        if self.samples == 0:
+            return None
+        return self.sumKmh / self.samples
+
+    def copy(self):
+        copy = SegmentStats.__new__(SegmentStats)
+        for name in self.__slots__:
+            setattr(copy, name, getattr(self, name))
+        return copy
+
+
+class _CarState(object):
+    __slots__ = ("segment", "splinePosition", "timeMs", "enteredMs", "stats")
+
+    def __init__(self, segmentCount):
+        self.segment = None
+        self.splinePosition = None
+        self.timeMs = None
+        self.enteredMs = None
+        self.stats = [SegmentStats() for _ in range(segmentCount)]
+
+
+class SectorAggregator(object):
+    """
+    Aggregates realtime car updates per car and per track segment as they come in. Each update is
+    processed in constant time, regardless of how long the session has been running.
+
+    Times are based on the session time of the latest realtime update, and segment crossings are
+    interpolated between samples. Statistics are reset when the session changes.
+
+    Args:
+        segments (int | list): Number of segments of equal length, or spline positions where each
+            segment starts, in increasing order and starting at 0.
+        resolution (int): Size of the table mapping spline positions to segments.
+    """
+
+    def __init__(self, segments=3, resolution: int = 1000):
+        if isinstance(segments, int):
+            boundaries = [i / segments for i in range(segments)]
+        else:
+            boundaries = list(segments)
+        if not boundaries or boundaries[0] != 0 or boundaries != sorted(set(boundaries)):
+            raise ValueError("Segments must start at 0 and be in increasing order")
+        self._boundaries = boundaries + [1.0]
+        self._resolution = resolution
+        self._lookup = []
+        segment = 0
+        for i in range(resolution):
+            while i / resolution >= self._boundaries[segment + 1]:
+                segment += 1
+            self._lookup.append(segment)
+        self._lock = Lock()
+        self._cars = {}
+        self._sessionIndex = None
+        self._sessionTimeMs = None
+
+    @property
+    def boundaries(self):
+        return self._boundaries[:-1]
+
+    def attach(self, client):
+        """
+        Subscribes to the realtime updates of a client.
+
+        Args:
+            client (AccClient): The client to aggregate updates from.
+        """
+        client.onRealtimeUpdate.subscribe(self.on_realtime_update)
+        client.onRealtimeCarUpdate.subscribe(self.on_realtime_car_update)
+
+    def reset(self):
+        with self._lock:
+            self._cars = {}
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Copies of the statistics of each segment by car index.
+        """
+        with self._lock:
+            return {
+                carIndex: tuple(stats.copy() for stats in car.stats)
+                for carIndex, car in self._cars.items()
+            }
+
+    def on_realtime_update(self, event):
+        update = event.content
+        if update.sessionIndex != self._sessionIndex or (
+            self._sessionTimeMs is not None and update.sessionTimeMs < self._sessionTimeMs
+        ):
+            self.reset()
+        self._sessionIndex = update.sessionIndex
+        self._sessionTimeMs = update.sessionTimeMs
+
+    def on_realtime_car_update(self, event):
+        update = event.content
+        nowMs = self._sessionTimeMs
+        if nowMs is None:
+            return
+        splinePosition = min(max(update.splinePosition, 0), 1)
+        segment = self._lookup[min(int(splinePosition * self._resolution), self._resolution - 1)]
+
+        with self._lock:
+            car = self._cars.get(update.carIndex)
+            if car is None:
+                car = self._cars[update.carIndex] = _CarState(len(self._boundaries) - 1)
+
+            # Speed and time spent in the pits
+            stats = car.stats[segment]
+            kmh = update.kmh
+            stats.samples += 1
+            stats.sumKmh += kmh
+            if stats.minKmh is None or kmh < stats.minKmh:
+                stats.minKmh = kmh
+            if stats.maxKmh is None or kmh > stats.maxKmh:
+                stats.maxKmh = kmh
+            if car.timeMs is not None and update.location in PIT_LOCATIONS:
+                stats.pitTimeMs += nowMs - car.timeMs
+
+            # Segment crossings, only sequential ones give a valid segment time. Crossing the
+            # start line is told by the spline position wrapping, which is the only crossing with
+            # a single segment.
+            wrapped = car.splinePosition is not None and car.splinePosition - splinePosition > 0.5
+            if car.segment is not None and (segment != car.segment or wrapped):
+                segmentCount = len(self._boundaries) - 1
+                if segment == (car.segment + 1) % segmentCount and wrapped == (segment == 0):
+                    boundary = self._boundaries[car.segment + 1]
+                    unwrapped = splinePosition + 1 if wrapped else splinePosition
+                    crossedMs = car.timeMs + (nowMs - car.timeMs) * (
+                        (boundary - car.splinePosition) / (unwrapped - car.splinePosition)
+                    )
+                    if car.enteredMs is not None:
+                        previous = car.stats[car.segment]
+                        previous.lastTimeMs = crossedMs - car.enteredMs
+                        previous.passes += 1
+                        if previous.bestTimeMs is None or previous.lastTimeMs < previous.bestTimeMs:
+                            previous.bestTimeMs = previous.lastTimeMs
+                    car.enteredMs = crossedMs
+                else:
+                    car.enteredMs = None
+            car.segment = segment
+            car.splinePosition = splinePosition
+            car.timeMs = nowMs
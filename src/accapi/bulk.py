@@ -0,0 +1,353 @@
+from concurrent.futures import ProcessPoolExecutor
+import struct
+
+import numpy as np
+
+__all__ = [
+    "LAP_DTYPE",
+    "REALTIME_UPDATE_DTYPE",
+    "REALTIME_CAR_UPDATE_DTYPE",
+    "DecodedArchive",
+    "index_datagrams",
+    "decode_datagrams",
+    "read_archive",
+    "write_archive",
+]
+
+# Wire layouts, without the message type byte
+_LAP_HEAD = np.dtype(
+    [("lapTimeMs", "<i4"), ("carIndex", "<u2"), ("driverIndex", "<u2"), ("splitCount", "u1")]
+)
+_LAP_TAIL = np.dtype(
+    [("isInvalid", "?"), ("isValidForBest", "?"), ("isOutlap", "?"), ("isInlap", "?")]
+)
+_REALTIME_HEAD = np.dtype(
+    [
+        ("eventIndex", "<u2"),
+        ("sessionIndex", "<u2"),
+        ("sessionType", "u1"),
+        ("sessionPhase", "u1"),
+        ("sessionTimeMs", "<f4"),
+        ("sessionEndTimeMs", "<f4"),
+        ("focusedCarIndex", "<i4"),
+    ]
+)
+_REALTIME_REPLAY = np.dtype([("replaySessionTime", "<f4"), ("replayRemainingTime", "<f4")])
+_REALTIME_WEATHER = np.dtype(
+    [
+        ("timeOfDayMs", "<f4"),
+        ("ambientTemp", "u1"),
+        ("trackTemp", "u1"),
+        ("clouds", "u1"),
+        ("rainLevel", "u1"),
+        ("wetness", "u1"),
+    ]
+)
+_REALTIME_CAR_HEAD = np.dtype(
+    [
+        ("carIndex", "<u2"),
+        ("driverIndex", "<u2"),
+        ("driverCount", "u1"),
+        ("gear", "u1"),
+        ("worldPosX", "<f4"),
+        ("worldPosY", "<f4"),
+        ("yaw", "<f4"),
+        ("location", "u1"),
+        ("kmh", "<u2"),
+        ("position", "<u2"),
+        ("cupPosition", "<u2"),
+        ("trackPosition", "<u2"),
+        ("splinePosition", "<f4"),
+        ("laps", "<u2"),
+        ("delta", "<i4"),
+    ]
+)
+_U2 = np.dtype("<u2")
+_I4 = np.dtype("<i4")
+_BOOL = np.dtype("?")
+
+# Decoded layouts, enums are kept as their numeric value, missing splits are 0
+LAP_DTYPE = np.dtype(
+    [
+        ("lapTimeMs", "<i4"),
+        ("carIndex", "<u2"),
+        ("driverIndex", "<u2"),
+        ("splitCount", "u1"),
+        ("splits", "<i4", (3,)),
+        ("isInvalid", "?"),
+        ("isValidForBest", "?"),
+        ("isOutlap", "?"),
+        ("isInlap", "?"),
+    ]
+)
+REALTIME_UPDATE_DTYPE = np.dtype(
+    [("index", "<i8")]
+    + _REALTIME_HEAD.descr
+    + [("isReplayPlaying", "?")]
+    + _REALTIME_REPLAY.descr
+    + [
+        ("timeOfDayMs", "<f4"),
+        ("ambientTemp", "u1"),
+        ("trackTemp", "u1"),
+        ("clouds", "<f4"),
+        ("rainLevel", "<f4"),
+        ("wetness", "<f4"),
+        ("bestSessionLap", LAP_DTYPE),
+    ]
+)
+REALTIME_CAR_UPDATE_DTYPE = np.dtype(
+    [("index", "<i8"), ("sessionTimeMs", "<f4")]
+    + [(name, "i1" if name == "gear" else dtype) for name, dtype in _REALTIME_CAR_HEAD.descr]
+    + [("bestSessionLap", LAP_DTYPE), ("lastLap", LAP_DTYPE), ("currentLap", LAP_DTYPE)]
+)
+
+
+class DecodedArchive(object):
+    """
+    Result of decoding many datagrams at once.
+
+    Attributes:
+        messageTypes (numpy.ndarray): Message type of each datagram.
+        realtimeUpdates (numpy.ndarray): Decoded realtime updates, see REALTIME_UPDATE_DTYPE. The
+            camera and HUD page names are not decoded.
+        realtimeCarUpdates (numpy.ndarray): Decoded realtime car updates, see
+            REALTIME_CAR_UPDATE_DTYPE. The session time is taken from the latest realtime update
+            received before, or NaN.
+        skipped (int): Number of realtime and realtime car updates too short to be decoded.
+
+    In both arrays, "index" is the position of the datagram in the archive.
+    """
+
+    def __init__(self, buffer, offsets, lengths, messageTypes, realtimeUpdates, realtimeCarUpdates):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._lengths = lengths
+        self.messageTypes = messageTypes
+        self.realtimeUpdates = realtimeUpdates
+        self.realtimeCarUpdates = realtimeCarUpdates
+        self.skipped = int(
+            np.count_nonzero(messageTypes == 2)
+            + np.count_nonzero(messageTypes == 3)
+            - len(realtimeUpdates)
+            - len(realtimeCarUpdates)
+        )
+
+    def __len__(self):
+        return len(self.messageTypes)
+
+    def car(self, carIndex: int):
+        """
+        Returns:
+            numpy.ndarray: Realtime car updates of a single car, in order.
+        """
+        return self.realtimeCarUpdates[self.realtimeCarUpdates["carIndex"] == carIndex]
+
+    def datagrams(self, messageType: int):
+        """
+        Iterates over the raw datagrams of a message type, for messages that aren't decoded in
+        bulk.
+
+        Yields:
+            bytes: Datagrams, including the message type.
+        """
+        for i in np.flatnonzero(self.messageTypes == messageType):
+            offset = self._offsets[i]
+            yield bytes(self._buffer[offset : offset + self._lengths[i]])
+
+
+def index_datagrams(buffer, lengthFormat: str = "<I"):
+    """
+    Finds the datagrams in a buffer of length prefixed datagrams. A truncated datagram at the end
+    is ignored.
+
+    Args:
+        buffer (bytes-like): The datagrams.
+        lengthFormat (str): struct format of the length prefix.
+
+    Returns:
+        tuple: Offsets and lengths of the datagrams, as numpy arrays.
+    """
+    prefix = struct.Struct(lengthFormat)
+    offsets = []
+    lengths = []
+    position = 0
+    end = len(buffer)
+    while position + prefix.size <= end:
+        (length,) = prefix.unpack_from(buffer, position)
+        position += prefix.size
+        if position + length > end:
+            break
+        if length > 0:
+            offsets.append(position)
+            lengths.append(length)
+        position += length
+    return np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+def _gather(raw, starts, dtype):
+    """
+    Reads one value of a given layout at each start position.
+    """
+    indices = starts[:, None] + np.arange(dtype.itemsize)
+    return np.take(raw, indices, mode="clip").view(dtype)[:, 0]
+
+
+def _decode_laps(raw, starts, laps):
+    """
+    Decodes laps starting at the given positions into a LAP_DTYPE array.
+
+    Returns:
+        numpy.ndarray: Positions right after each lap.
+    """
+    head = _gather(raw, starts, _LAP_HEAD)
+    for name in _LAP_HEAD.names:
+        laps[name] = head[name]
+    counts = head["splitCount"].astype(np.int64)
+    splits = laps["splits"]
+    for i in range(splits.shape[1]):
+        splits[:, i] = np.where(
+            counts > i, _gather(raw, starts + _LAP_HEAD.itemsize + 4 * i, _I4), 0
+        )
+    tailStarts = starts + _LAP_HEAD.itemsize + 4 * counts
+    tail = _gather(raw, tailStarts, _LAP_TAIL)
+    for name in _LAP_TAIL.names:
+        laps[name] = tail[name]
+    return tailStarts + _LAP_TAIL.itemsize
+
+
+def _decode_realtime_updates(raw, offsets, lengths, indices):
+    out = np.zeros(len(offsets), dtype=REALTIME_UPDATE_DTYPE)
+    out["index"] = indices
+    head = _gather(raw, offsets + 1, _REALTIME_HEAD)
+    for name in _REALTIME_HEAD.names:
+        out[name] = head[name]
+
+    # Skip the camera and HUD page names
+    positions = offsets + 1 + _REALTIME_HEAD.itemsize
+    for _ in range(3):
+        positions = positions + 2 + _gather(raw, positions, _U2).astype(np.int64)
+
+    # Replay times are only present during replays
+    isReplayPlaying = _gather(raw, positions, _BOOL)
+    out["isReplayPlaying"] = isReplayPlaying
+    positions = positions + 1
+    replay = _gather(raw, positions, _REALTIME_REPLAY)
+    for name in _REALTIME_REPLAY.names:
+        out[name] = np.where(isReplayPlaying, replay[name], 0)
+    positions = positions + _REALTIME_REPLAY.itemsize * isReplayPlaying
+
+    # Weather and best lap
+    weather = _gather(raw, positions, _REALTIME_WEATHER)
+    for name in ("timeOfDayMs", "ambientTemp", "trackTemp"):
+        out[name] = weather[name]
+    for name in ("clouds", "rainLevel", "wetness"):
+        out[name] = weather[name] / 10
+    ends = _decode_laps(raw, positions + _REALTIME_WEATHER.itemsize, out["bestSessionLap"])
+    return out[ends <= offsets + lengths]
+
+
+def _decode_realtime_car_updates(raw, offsets, lengths, indices):
+    out = np.zeros(len(offsets), dtype=REALTIME_CAR_UPDATE_DTYPE)
+    out["index"] = indices
+    out["sessionTimeMs"] = np.nan
+    head = _gather(raw, offsets + 1, _REALTIME_CAR_HEAD)
+    for name in _REALTIME_CAR_HEAD.names:
+        out[name] = head[name]
+    out["gear"] = head["gear"].astype(np.int8) - 2
+    positions = offsets + 1 + _REALTIME_CAR_HEAD.itemsize
+    for name in ("bestSessionLap", "lastLap", "currentLap"):
+        positions = _decode_laps(raw, positions, out[name])
+    return out[positions <= offsets + lengths]
+
+
+def _decode_chunk(buffer, offsets, lengths, firstIndex):
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    indices = np.arange(firstIndex, firstIndex + len(offsets), dtype=np.int64)
+    messageTypes = raw[offsets] if len(offsets) else np.zeros(0, dtype=np.uint8)
+    decoded = []
+    for messageType, decode in ((2, _decode_realtime_updates), (3, _decode_realtime_car_updates)):
+        selected = messageTypes == messageType
+        decoded.append(decode(raw, offsets[selected], lengths[selected], indices[selected]))
+    return (messageTypes, *decoded)
+
+
+def decode_datagrams(
+    buffer, lengthFormat: str = "<I", processes: int = None, chunkSize: int = 1000000
+):
+    """
+    Decodes the realtime and realtime car updates of many length prefixed datagrams at once, such
+    as a capture of a whole race.
+
+    Args:
+        buffer (bytes-like): The datagrams.
+        lengthFormat (str): struct format of the length prefix.
+        processes (int): Number of processes to decode with, or None to decode in this process.
+        chunkSize (int): Number of datagrams decoded at a time, which bounds the memory used
+            while decoding.
+
+    Returns:
+        DecodedArchive: The decoded updates.
+    """
+    offsets, lengths = index_datagrams(buffer, lengthFormat)
+
+    # Chunks bound the memory used by the intermediate index matrices
+    if processes is None or len(offsets) <= chunkSize:
+        results = [
+            _decode_chunk(
+                buffer,
+                offsets[first : first + chunkSize],
+                lengths[first : first + chunkSize],
+                first,
+            )
+            for first in range(0, max(len(offsets), 1), chunkSize)
+        ]
+    else:
+        view = memoryview(buffer)
+        chunks = []
+        for first in range(0, len(offsets), chunkSize):
+            chunkOffsets = offsets[first : first + chunkSize]
+            chunkLengths = lengths[first : first + chunkSize]
+            start = chunkOffsets[0]
+            end = chunkOffsets[-1] + chunkLengths[-1]
+            chunks.append((bytes(view[start:end]), chunkOffsets - start, chunkLengths, first))
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(_decode_chunk, *zip(*chunks)))
+    if len(results) == 1:
+        messageTypes, realtimeUpdates, realtimeCarUpdates = results[0]
+    else:
+        messageTypes, realtimeUpdates, realtimeCarUpdates = (
+            np.concatenate(decoded) for decoded in zip(*results)
+        )
+
+    # Attach the session time of the latest realtime update to each car update
+    latest = np.searchsorted(realtimeUpdates["index"], realtimeCarUpdates["index"]) - 1
+    if len(realtimeUpdates):
+        sessionTimes = realtimeUpdates["sessionTimeMs"][np.maximum(latest, 0)]
+        realtimeCarUpdates["sessionTimeMs"] = np.where(latest >= 0, sessionTimes, np.nan)
+
+    return DecodedArchive(
+        buffer, offsets, lengths, messageTypes, realtimeUpdates, realtimeCarUpdates
+    )
+
+
+def read_archive(path: str, **kwargs):
+    """
+    Decodes a file of length prefixed datagrams, see decode_datagrams.
+    """
+    with open(path, "rb") as f:
+        return decode_datagrams(f.read(), **kwargs)
+
+
+def write_archive(f, datagrams, lengthFormat: str = "<I"):
+    """
+    Writes datagrams with a length prefix, in the format expected by decode_datagrams.
+
+    Args:
+        f (file): A file opened in binary mode.
+        datagrams (iterable): The datagrams.
+        lengthFormat (str): struct format of the length prefix.
+    """
+    prefix = struct.Struct(lengthFormat)
+    for datagram in datagrams:
+        f.write(prefix.pack(len(datagram)))
+        f.write(datagram)
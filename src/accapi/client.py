@@ -1,8 +1,14 @@
-from threading import Thread, Condition
+from collections import deque
+from threading import Lock, Thread, current_thread
+import selectors
 import socket
 import struct
+import sys
+import time
+import weakref
 
 from .enums import OutboundMessageTypes
+from .eventlog import BroadcastingEventLog
 from .structs import (
     RegistrationResult,
     RealtimeUpdate,
@@ -15,146 +21,341 @@ from .structs import (
 
 __all__ = ["AccClient"]
 
+# Not exposed by the socket module, the value is the same on most Linux architectures
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35 if sys.platform == "linux" else None)
+_timespec = struct.Struct("@ll")
+
 
 class EndOfStreamError(Exception):
     pass
 
 
-class ThreadedSocketReader(object):
+class DatagramReader(object):
     """
-    Reads from a socket continuously and provides a non-blocking read method.
+    Reads sequentially from a single datagram.
 
     Args:
-        source (socket.socket): A socket instance.
-        chunkSize (int): The data will be read in chunks of the given size.
-
-    Attributes:
-        isAlive (bool): The reader will terminate its thread if the source has been closed.
-        size (int): How much data has been read so far.
+        data (bytes): The datagram payload.
+        offset (int): Where to start reading.
     """
 
-    def __init__(self, source: socket.socket, chunkSize: int = 1024):
-        self._source = source
-        self._chunkSize = chunkSize
-        self._data = bytearray()
-        self._dataLock = Condition()
-        self._stopSignal = False
-        self._thread = Thread(target=self._run)
-        self._thread.setDaemon(True)
-        self._thread.start()
-        self._exception = None
+    def __init__(self, data: bytes, offset: int = 0):
+        self._data = data
+        self._offset = offset
 
-    @property
-    def isAlive(self):
-        if self._thread is None:
-            return False
-        return self._thread.is_alive()
+    def read(self, size: int):
+        """
+        Reads raw bytes.
 
-    @property
-    def size(self):
-        self._dataLock.acquire()
-        size = len(self._data)
-        self._dataLock.release()
-        return size
+        Args:
+            size (int): Number of bytes to read.
 
-    def read(self, size: int = None, timeout: int = None):
+        Returns:
+            bytes: The requested data.
+        """
+        end = self._offset + size
+        if end > len(self._data):
+            raise EndOfStreamError()
+        data = self._data[self._offset : end]
+        self._offset = end
+        return data
+
+    def unpack(self, fmt: struct.Struct):
         """
-        Reads data from the stream.
+        Reads and unpacks values.
 
         Args:
-            size (int): Number of bytes to read, or None to read everything that is available.
-            timeout (float): Only used if size is not None. Number of seconds to wait for the method
-                to return data, or None.
+            fmt (struct.Struct): The layout of the values.
 
         Returns:
-            bytes: The requested data, or None.
-        """
-        # Raise exception if no data will ever come in
-        self._dataLock.acquire()
-        if not self.isAlive and (not self._data or (size is not None and len(self._data) < size)):
-            self._dataLock.release()
-            if self._exception is not None:
-                raise self._exception
-            else:
-                raise EndOfStreamError()
+            tuple: The unpacked values.
+        """
+        if self._offset + fmt.size > len(self._data):
+            raise EndOfStreamError()
+        values = fmt.unpack_from(self._data, self._offset)
+        self._offset += fmt.size
+        return values
 
-        # Return all available data
-        if size is None:
-            if len(self._data) > 0:
-                data = bytes(self._data)
-                self._data = bytearray()
-            else:
-                data = None
 
-        # Return specified amount of data
+class Event(object):
+    """
+    Args:
+        source (AccClient): The client that received the content.
+        content: The received content.
+        receivedNs (int): When the datagram was received, only when timestamps are enabled.
+        decodedNs (int): When the content was decoded, only when timestamps are enabled.
+        dispatchedNs (int): When dispatching to callbacks started, only when timestamps are
+            enabled.
+
+    Times are in nanoseconds according to the clock of the source.
+    """
+
+    def __init__(
+        self,
+        source,
+        content,
+        receivedNs: int = None,
+        decodedNs: int = None,
+        dispatchedNs: int = None,
+    ):
+        self.source = source
+        self.content = content
+        self.receivedNs = receivedNs
+        self.decodedNs = decodedNs
+        self.dispatchedNs = dispatchedNs
+
+
+class Subscription(object):
+    """
+    Handle of a callback subscribed to an Observable, usable as a context manager.
+
+    Attributes:
+        callback (callable): The subscribed callback, or None once a weakly referenced callback
+            has been garbage collected.
+        carIndices (frozenset): Car indices routed to the callback, or None for any.
+        eventTypes (frozenset): Content types routed to the callback, or None for any.
+        receiveDuplicates (bool): Whether the callback is called back for skipped duplicates.
+    """
+
+    def __init__(self, observable, callback, carIndices, eventTypes, receiveDuplicates, weak):
+        self._observable = observable
+        self.carIndices = carIndices
+        self.eventTypes = eventTypes
+        self.receiveDuplicates = receiveDuplicates
+        self._ref = None
+        if not weak:
+            self._target = callback
+            return
+
+        # Bound methods are created on each attribute access, reference their instance instead
+        if hasattr(callback, "__self__") and hasattr(callback, "__func__"):
+            ref = weakref.WeakMethod(callback, self._on_collected)
         else:
+            ref = weakref.ref(callback, self._on_collected)
+        self._ref = ref
 
-            # Wait until there's enough data to fulfill the request
-            if len(self._data) < size and not self._dataLock.wait(timeout):
+        def target(event):
+            callback = ref()
+            if callback is not None:
+                callback(event)
 
-                # No data after timeout
-                data = None
+        self._target = target
 
-            # Slice data according to size
-            else:
-                data = bytes(self._data[:size])
-                del self._data[:size]
+    @property
+    def callback(self):
+        if self._ref is not None:
+            return self._ref()
+        return self._target
 
-        # Release and return
-        self._dataLock.release()
-        return data
+    @property
+    def active(self):
+        return self in self._observable._subscriptions
 
-    def stop(self):
+    def _on_collected(self, ref):
+        self._observable._discard(self)
+
+    def matches(self, carIndex, eventType):
+        return (self.carIndices is None or carIndex in self.carIndices) and (
+            self.eventTypes is None or eventType in self.eventTypes
+        )
+
+    def unsubscribe(self):
         """
-        Signals the reader to stop.
+        Stops calling back, does nothing if already unsubscribed.
         """
-        self._stopSignal = True
-        self._thread = None
+        self._observable._update(lambda subscriptions: (s for s in subscriptions if s is not self))
 
-    def _run(self):
-        while not self._stopSignal:
-            try:
-                data = self._source.recv(self._chunkSize)
-            except socket.timeout:
-                continue
-            except Exception as e:
-                self._exception = e
-                break
-            self._dataLock.acquire()
-            self._data.extend(data)
-            self._dataLock.notify_all()
-            self._dataLock.release()
+    def __enter__(self):
+        return self
 
-
-class Event(object):
-    def __init__(self, source, content):
-        self.source = source
-        self.content = content
+    def __exit__(self, *exc):
+        self.unsubscribe()
 
 
 class Observable(object):
+    """
+    Registry of callbacks. Subscribing and unsubscribing rebuild an immutable routing table, so
+    dispatching never copies or locks, and callbacks can subscribe or unsubscribe while being
+    called.
+    """
+
     def __init__(self):
-        self._callbacks = []
+        self._lock = Lock()
+        self._subscriptions = ()
+        self._collected = deque()
+        self._compile()
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
 
     @property
     def callbacks(self):
-        return self._callbacks[:]
+        """
+        Every subscribed callback in subscription order, whatever the content it is routed. See
+        route for the callbacks of a given content.
+        """
+        callbacks = (subscription.callback for subscription in self._subscriptions)
+        return tuple(callback for callback in callbacks if callback is not None)
+
+    def _compile(self):
+        subscriptions = self._subscriptions
+        carIndices = set()
+        eventTypes = set()
+        for subscription in subscriptions:
+            carIndices.update(subscription.carIndices or ())
+            eventTypes.update(subscription.eventTypes or ())
+
+        # One entry per combination of routed values, None standing for any other value
+        table = {}
+        duplicateTable = {}
+        for carIndex in carIndices | {None}:
+            for eventType in eventTypes | {None}:
+                matching = [s for s in subscriptions if s.matches(carIndex, eventType)]
+                table[(carIndex, eventType)] = tuple(s._target for s in matching)
+                duplicateTable[(carIndex, eventType)] = tuple(
+                    s._target for s in matching if s.receiveDuplicates
+                )
+
+        # Swapped in a single assignment so readers never see a partial table
+        self._routes = (frozenset(carIndices), frozenset(eventTypes), table, duplicateTable)
+
+    def route(self, content, duplicates: bool = False):
+        """
+        Args:
+            content: The content to dispatch.
+            duplicates (bool): Whether the content is a skipped duplicate.
+
+        Returns:
+            tuple: Callbacks to call with the content, in subscription order.
+        """
+        carIndices, eventTypes, table, duplicateTable = self._routes
+        carIndex = None
+        eventType = None
+        if carIndices:
+            carIndex = getattr(content, "carIndex", None)
+            if carIndex not in carIndices:
+                carIndex = None
+        if eventTypes:
+            eventType = getattr(content, "type", None)
+            if eventType not in eventTypes:
+                eventType = None
+        return (duplicateTable if duplicates else table)[(carIndex, eventType)]
+
+    def subscribe(
+        self,
+        callback,
+        receiveDuplicates: bool = False,
+        carIndex=None,
+        eventType=None,
+        weak: bool = False,
+    ):
+        """
+        Args:
+            callback (callable): Called with an Event.
+            receiveDuplicates (bool): When the client skips payloads identical to the previous one,
+                call back again with the previous content instead of not at all.
+            carIndex (int | iterable): Only call back for content of these cars, or None for any.
+                Content without a car index never matches.
+            eventType (str | iterable): Only call back for content of these types, such as
+                broadcasting events of type "Accident", or None for any.
+            weak (bool): Hold a weak reference to the callback, which is unsubscribed once garbage
+                collected.
+
+        Returns:
+            Subscription: Handle to unsubscribe the callback.
+        """
+        if carIndex is not None:
+            carIndex = frozenset((carIndex,) if isinstance(carIndex, int) else carIndex)
+        if eventType is not None:
+            eventType = frozenset((eventType,) if isinstance(eventType, str) else eventType)
+        subscription = Subscription(self, callback, carIndex, eventType, receiveDuplicates, weak)
+        self._update(lambda subscriptions: subscriptions + (subscription,))
+        return subscription
+
+    def unsubscribe(self, callback):
+        """
+        Unsubscribes every subscription of a callback.
+
+        Args:
+            callback (callable): A subscribed callback.
+        """
+        self._update(lambda subscriptions: (s for s in subscriptions if s.callback != callback))
 
-    def subscribe(self, callback):
-        self._callbacks.append(callback)
+    def _update(self, change):
+        """
+        Changes the subscriptions and rebuilds the routing table.
+
+        Args:
+            change (callable): Given the current subscriptions, returns the new ones.
+        """
+        with self._lock:
+            self._apply(change)
+
+        # Weak callbacks collected while the lock was held
+        while self._collected:
+            with self._lock:
+                self._apply(None)
+
+    def _discard(self, subscription):
+        """
+        Removes the subscription of a collected weak callback. The garbage collector may call this
+        while any thread, including this one, is updating the subscriptions, in which case the
+        removal is left to that update.
+        """
+        self._collected.append(subscription)
+        while self._collected and self._lock.acquire(blocking=False):
+            try:
+                self._apply(None)
+            finally:
+                self._lock.release()
+
+    def _apply(self, change):
+        subscriptions = self._subscriptions
+        if change is not None:
+            subscriptions = tuple(change(subscriptions))
+        while self._collected:
+            collected = self._collected.popleft()
+            subscriptions = tuple(s for s in subscriptions if s is not collected)
+        if subscriptions != self._subscriptions:
+            self._subscriptions = subscriptions
+            self._compile()
 
 
 class AccClient(object):
 
     endianess = "<"
+    maxDatagramsPerRead = 64
+    maxDatagramsPerDrain = 4096
 
-    def __init__(self):
+    # Adaptive update interval, load is the fraction of time spent decoding and dispatching
+    adaptiveHighLoad = 0.5
+    adaptiveLowLoad = 0.1
+    adaptiveWindowIntervals = 20
+
+    def __init__(self, eventLogSize: int = 1000):
         self._server = (None, None)
         self._displayName = None
         self._updateIntervalMs = 100
+        self._password = None
+        self._commandPassword = None
         self._socket = None
         self._connectionState = "disconnected"
 
+        # Connection supervision
+        self._livenessTimeoutMs = None
+        self._reconnect = True
+        self._reconnectDelayMs = 250
+        self._reconnectMaxDelayMs = 5000
+        self._reconnectAttempts = 0
+        self._deadline = None
+
+        # Adaptive update interval
+        self._adaptiveUpdateIntervalMs = None
+        self._windowStart = None
+        self._busyTime = 0
+        self._maxBurstTime = 0
+
         # Callbacks
         self._onConnectionStateChange = Observable()
         self._onTrackDataUpdate = Observable()
@@ -169,6 +370,9 @@ class AccClient(object):
         self._writable = False
         self._entryList = []
         self._cars = {}
+        self._eventLog = BroadcastingEventLog(eventLogSize)
+        self._sessionIndex = None
+        self._sessionTimeMs = None
 
         # Receive methods
         self._receiveMethods = {
@@ -181,15 +385,47 @@ class AccClient(object):
             7: self._receive_broadcasting_event,
         }
 
+        # Deduplication, by message type: length of the key prefix and duplicate receive method
+        self._deduplicate = False
+        self._duplicates = {}
+        self._duplicateCount = 0
+        self._duplicateMethods = {
+            3: (3, self._receive_duplicate_realtime_car_update),
+            4: (5, self._receive_duplicate_entry_list),
+            5: (5, self._receive_duplicate_track_data),
+            6: (3, self._receive_duplicate_entry_list_car),
+        }
+
+        # Conflation, by message type: length of the key prefix identifying the stream
+        self._conflate = False
+        self._conflatedCount = 0
+        self._conflatedKeyLengths = {2: 1, 3: 3}
+        self._receiveBufferSize = None
+
+        # Timestamps
+        self._timestamps = False
+        self._kernelTimestamps = False
+        self._ancillarySize = 0
+        self._clock = time.monotonic_ns
+        self._receivedNs = None
+        self._decodedNs = None
+
+        # Precompiled single value formats
+        self._structs = {f: struct.Struct(f"{self.endianess}{f}") for f in "?bBhHiIf"}
+
         # Thread
         self._stopSignal = False
         self._thread = None
         self._reader = None
+        self._selector = None
+        self._wakeupReceiver = None
+        self._wakeupSender = None
+        self._commands = deque()
 
     def _update_connection_state(self, state):
         if state != self._connectionState:
             self._connectionState = state
-            for callback in self._onConnectionStateChange.callbacks:
+            for callback in self._onConnectionStateChange.route(state):
                 callback(Event(self, content=self._connectionState))
 
     @property
@@ -200,6 +436,36 @@ class AccClient(object):
     def writable(self):
         return self._writable
 
+    @property
+    def updateIntervalMs(self):
+        return self._updateIntervalMs
+
+    @property
+    def eventLog(self):
+        """
+        Broadcasting events of the current session, cleared when the session changes.
+        """
+        return self._eventLog
+
+    @property
+    def duplicateCount(self):
+        return self._duplicateCount
+
+    @property
+    def conflatedCount(self):
+        return self._conflatedCount
+
+    @property
+    def clock(self):
+        """
+        Function returning the current time in nanoseconds, comparable to event timestamps.
+        """
+        return self._clock
+
+    @property
+    def kernelTimestamps(self):
+        return self._kernelTimestamps
+
     @property
     def onConnectionStateChange(self):
         return self._onConnectionStateChange
@@ -242,83 +508,180 @@ class AccClient(object):
                 fmt += f
                 values.append(v)
         packed = struct.pack(fmt, *values)
-        self._socket.sendto(packed, self._server)
+
+        # Socket I/O stays on the client thread, requests from other threads are queued to it
+        if current_thread() is self._thread:
+            self._sendto(packed)
+        else:
+            self._post(lambda: self._sendto(packed))
+
+    def _sendto(self, packed: bytes):
+        if self._socket is None:
+            return
+        try:
+            self._socket.sendto(packed, self._server)
+        except OSError:
+            # Like a lost datagram, such as while the network is down, registration is retried
+            # once the deadline passes
+            pass
 
     def _receive(self, fmt):
         out = []
         for f in fmt:
             if f == "s":
-                (length,) = struct.unpack(f"{self.endianess}H", self._reader.read(2))
-                if length > 0:
-                    out.append(self._reader.read(length).decode("utf8"))
-                else:
-                    out.append("")
+                (length,) = self._reader.unpack(self._structs["H"])
+                out.append(self._reader.read(length).decode("utf8"))
             else:
-                (val,) = struct.unpack(
-                    f"{self.endianess}{f}", self._reader.read(struct.calcsize(f))
-                )
+                (val,) = self._reader.unpack(self._structs[f])
                 out.append(val)
         return out
 
+    def _decode(self, cls):
+        content = cls.receive(self._receive)
+        if self._timestamps:
+            self._decodedNs = self._clock()
+        return content
+
+    def _dispatch(self, observable, content, duplicates=False):
+        callbacks = observable.route(content, duplicates)
+        if self._timestamps:
+            dispatchedNs = self._clock()
+            for callback in callbacks:
+                callback(Event(self, content, self._receivedNs, self._decodedNs, dispatchedNs))
+        else:
+            for callback in callbacks:
+                callback(Event(self, content))
+
+    def _receive_datagram(self, data: bytes):
+        if not data:
+            return False
+        receiveMethod = self._receiveMethods.get(data[0])
+        if receiveMethod is None:
+            return False
+
+        # Skip decoding payloads identical to the previous one of the same entity
+        key = None
+        if self._deduplicate and data[0] in self._duplicateMethods:
+            keyLength, duplicateMethod = self._duplicateMethods[data[0]]
+            key = data[:keyLength]
+            previous = self._duplicates.get(key)
+            if previous is not None and previous[0] == data:
+                if self._timestamps:
+                    self._decodedNs = self._clock()
+                if duplicateMethod(previous[1]):
+                    self._duplicateCount += 1
+                    return True
+
+        # Decode
+        self._reader = DatagramReader(data, 1)
+        try:
+            content = receiveMethod()
+        except (EndOfStreamError, UnicodeDecodeError):
+            return False
+        finally:
+            self._reader = None
+        if key is not None:
+            if content is None:
+                self._duplicates.pop(key, None)
+            else:
+                self._duplicates[key] = (data, content)
+        return True
+
     def _receive_registration_result(self):
-        result = RegistrationResult.receive(self._receive)
+        result = self._decode(RegistrationResult)
         if not result.success:
             self._stop(state=f"rejected ({result.errorMessage})")
+            return
         self._connectionId = result.connectionId
         self._writable = result.writable
+        self._reconnectAttempts = 0
+        self._deadline = time.monotonic() + self._livenessTimeoutMs / 1000
+        self._reset_load_window()
+        self._duplicates.clear()
         self._update_connection_state("established")
         self._request_entry_list()
         self._request_track_data()
 
     def _receive_realtime_update(self):
-        args = RealtimeUpdate.receive_args(self._receive)
-        for callback in self._onRealtimeUpdate.callbacks:
-            update = RealtimeUpdate(*args)
-            callback(Event(self, update))
+        update = self._decode(RealtimeUpdate)
+
+        # Event times are session times, which restart with each session
+        if self._sessionIndex is not None and (
+            update.sessionIndex != self._sessionIndex or update.sessionTimeMs < self._sessionTimeMs
+        ):
+            self._eventLog.clear()
+        self._sessionIndex = update.sessionIndex
+        self._sessionTimeMs = update.sessionTimeMs
+        self._dispatch(self._onRealtimeUpdate, update)
 
     def _receive_realtime_car_update(self):
-        args = RealtimeCarUpdate.receive_args(self._receive)
-        update = RealtimeCarUpdate(*args)
-        if update.carIndex in self._cars and self._cars[update.carIndex] == update.driverCount:
-            for callback in self._onRealtimeCarUpdate.callbacks:
-                update = RealtimeCarUpdate(*args)
-                callback(Event(self, update))
-        else:
+        update = self._decode(RealtimeCarUpdate)
+        if self._cars.get(update.carIndex) != update.driverCount:
             self._request_entry_list()
+            return None
+        self._dispatch(self._onRealtimeCarUpdate, update)
+        return update
+
+    def _receive_duplicate_realtime_car_update(self, update):
+        if self._cars.get(update.carIndex) != update.driverCount:
+            return False
+        self._dispatch(self._onRealtimeCarUpdate, update, duplicates=True)
+        return True
 
     def _receive_entry_list(self):
-        entryList = EntryList.receive(self._receive)
+        entryList = self._decode(EntryList)
         self._cars = {i: self._cars[i] if i in self._cars else -1 for i in entryList.carIndices}
+        return entryList
+
+    def _receive_duplicate_entry_list(self, entryList):
+        return True
 
     def _receive_entry_list_car(self):
-        args = EntryListCar.receive_args(self._receive)
-        car = EntryListCar(*args)
+        car = self._decode(EntryListCar)
+        self._cars[car.carIndex] = len(car.drivers)
+        self._dispatch(self._onEntryListCarUpdate, car)
+        return car
+
+    def _receive_duplicate_entry_list_car(self, car):
         self._cars[car.carIndex] = len(car.drivers)
-        for callback in self._onEntryListCarUpdate.callbacks:
-            car = EntryListCar(*args)
-            callback(Event(self, car))
+        self._dispatch(self._onEntryListCarUpdate, car, duplicates=True)
+        return True
 
     def _receive_track_data(self):
-        args = TrackData.receive_args(self._receive)
-        for callback in self._onTrackDataUpdate.callbacks:
-            data = TrackData(*args)
-            callback(Event(self, data))
+        data = self._decode(TrackData)
+        self._dispatch(self._onTrackDataUpdate, data)
+        return data
+
+    def _receive_duplicate_track_data(self, data):
+        self._dispatch(self._onTrackDataUpdate, data, duplicates=True)
+        return True
 
     def _receive_broadcasting_event(self):
-        args = BroadcastingEvent.receive_args(self._receive)
-        for callback in self._onBroadcastingEvent.callbacks:
-            event = BroadcastingEvent(*args)
-            callback(Event(self, event))
+        event = self._decode(BroadcastingEvent)
+        self._eventLog.add(event)
+        self._dispatch(self._onBroadcastingEvent, event)
 
-    def _request_connection(self, password: str, commandPassword: str):
+    def _request_connection(self):
         self._send(
             ("B", OutboundMessageTypes.REGISTER_COMMAND_APPLICATION.value),
             ("B", self._broadcastingProtocolVersion),
             ("s", self._displayName),
-            ("s", password),
+            ("s", self._password),
             ("i", self._updateIntervalMs),
-            ("s", commandPassword),
+            ("s", self._commandPassword),
+        )
+
+    def _register(self):
+        """
+        Requests a connection and waits for the registration result, backing off on each
+        consecutive attempt.
+        """
+        self._request_connection()
+        delayMs = min(
+            self._reconnectDelayMs * 2**self._reconnectAttempts, self._reconnectMaxDelayMs
         )
+        self._reconnectAttempts += 1
+        self._deadline = time.monotonic() + delayMs / 1000
 
     def _request_disconnection(self):
         self._send(
@@ -369,6 +732,31 @@ class AccClient(object):
             ("s", camera),
         )
 
+    def request_event_replay(
+        self,
+        events: list,
+        preRollMs: float = 5000,
+        postRollMs: float = 5000,
+        cameraSet: str = "",
+        camera: str = "",
+    ):
+        """
+        Requests an instant replay covering the given events, such as the result of an event log
+        query. The replay follows the car involved if all the events involve the same one.
+
+        Args:
+            events (list): Broadcasting events to replay.
+            preRollMs (float): Time to replay before the first event.
+            postRollMs (float): Time to replay after the last event.
+        """
+        if not events:
+            raise ValueError("No events to replay")
+        startTime = max(min(e.timeMs for e in events) - preRollMs, 0)
+        endTime = max(e.timeMs for e in events) + postRollMs
+        carIndices = {e.carIndex for e in events}
+        carIndex = carIndices.pop() if len(carIndices) == 1 else -1
+        self.request_instant_replay(startTime, endTime - startTime, carIndex, cameraSet, camera)
+
     def request_hud_page(self, pageName: str):
         self._send(
             ("B", OutboundMessageTypes.CHANGE_HUD_PAGE.value),
@@ -376,27 +764,219 @@ class AccClient(object):
             ("s", pageName),
         )
 
+    def _open_socket(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        if self._receiveBufferSize is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._receiveBufferSize)
+        self._selector.register(self._socket, selectors.EVENT_READ, self._read_socket)
+
+        # Prefer kernel receive timestamps, which use the realtime clock
+        self._kernelTimestamps = False
+        self._clock = time.monotonic_ns
+        if self._timestamps and SO_TIMESTAMPNS is not None and hasattr(self._socket, "recvmsg"):
+            try:
+                self._socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            except OSError:
+                pass
+            else:
+                self._kernelTimestamps = True
+                self._clock = time.time_ns
+                self._ancillarySize = socket.CMSG_SPACE(_timespec.size)
+
+    def _recv(self):
+        if self._kernelTimestamps:
+            return self._recv_timestamped()
+        data = self._socket.recv(65535)
+        if self._timestamps:
+            self._receivedNs = self._clock()
+        return data
+
+    def _recv_timestamped(self):
+        data, ancillary, _, _ = self._socket.recvmsg(65535, self._ancillarySize)
+        for level, kind, value in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = _timespec.unpack_from(value)
+                self._receivedNs = seconds * 1000000000 + nanoseconds
+                break
+        else:
+            self._receivedNs = self._clock()
+        return data
+
+    def _close_socket(self):
+        if self._socket is None:
+            return
+        self._selector.unregister(self._socket)
+        self._socket.close()
+        self._socket = None
+
+    def _reconnect_socket(self):
+        """
+        Replaces the socket, which gets a new local port from the OS, then registers again.
+        """
+        self._close_socket()
+        self._open_socket()
+        self._update_connection_state("connecting")
+        self._register()
+
+    def _post(self, command):
+        """
+        Runs a command on the client thread and wakes it up.
+
+        Args:
+            command (callable): Called without arguments.
+        """
+        self._commands.append(command)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeupSender.send(b"\0")
+        except OSError:
+            # Already woken up, or shutting down
+            pass
+
+    def _read_wakeup(self):
+        try:
+            while self._wakeupReceiver.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        while self._commands:
+            self._commands.popleft()()
+
+    def _read_socket(self):
+        burstStart = time.perf_counter()
+        try:
+            if self._conflate:
+                self._read_socket_conflated()
+                return
+
+            # Go back to the selector regularly so commands and supervision aren't starved
+            for _ in range(self.maxDatagramsPerRead):
+                try:
+                    data = self._recv()
+                except BlockingIOError:
+                    return
+                except ConnectionResetError:
+                    # Report a lost connection right away, registration retries keep their backoff
+                    if self._connectionState == "established":
+                        self._deadline = 0
+                    return
+                if self._receive_datagram(data) and self._connectionState == "established":
+                    self._deadline = time.monotonic() + self._livenessTimeoutMs / 1000
+                if self._stopSignal or self._socket is None:
+                    return
+        finally:
+            burstTime = time.perf_counter() - burstStart
+            self._busyTime += burstTime
+            self._maxBurstTime = max(self._maxBurstTime, burstTime)
+
+    def _read_socket_conflated(self):
+        """
+        Drains everything queued on the socket, then only decodes the latest realtime update and
+        the latest realtime car update of each car. Other messages are all decoded, in order.
+        """
+        datagrams = []
+        while len(datagrams) < self.maxDatagramsPerDrain:
+            try:
+                data = self._recv()
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                if self._connectionState == "established":
+                    self._deadline = 0
+                break
+            if data:
+                datagrams.append((data, self._receivedNs))
+
+        # Find the latest update of each conflated stream
+        latest = {}
+        if len(datagrams) > 1:
+            for i, (data, _) in enumerate(datagrams):
+                keyLength = self._conflatedKeyLengths.get(data[0])
+                if keyLength is not None:
+                    latest[data[:keyLength]] = i
+
+        # Decode
+        for i, (data, receivedNs) in enumerate(datagrams):
+            keyLength = self._conflatedKeyLengths.get(data[0])
+            if keyLength is not None and latest.get(data[:keyLength], i) != i:
+                self._conflatedCount += 1
+                continue
+            self._receivedNs = receivedNs
+            if self._receive_datagram(data) and self._connectionState == "established":
+                self._deadline = time.monotonic() + self._livenessTimeoutMs / 1000
+            if self._stopSignal or self._socket is None:
+                return
+
+    def _reset_load_window(self):
+        self._windowStart = time.perf_counter()
+        self._busyTime = 0
+        self._maxBurstTime = 0
+
+    def _adapt_update_interval(self):
+        """
+        Registers again with a longer update interval when decoding and dispatching can't keep
+        up, or a shorter one when mostly idle. The session state is kept as is.
+        """
+        elapsed = time.perf_counter() - self._windowStart
+        if elapsed * 1000 < self.adaptiveWindowIntervals * self._updateIntervalMs:
+            return
+        load = self._busyTime / elapsed
+        lagging = self._maxBurstTime * 1000 > self._updateIntervalMs
+        self._reset_load_window()
+        if self._connectionState != "established":
+            return
+
+        # Pick the new interval within bounds
+        minIntervalMs, maxIntervalMs = self._adaptiveUpdateIntervalMs
+        if load > self.adaptiveHighLoad or lagging:
+            intervalMs = min(int(self._updateIntervalMs * 1.5), maxIntervalMs)
+        elif load < self.adaptiveLowLoad:
+            intervalMs = max(int(self._updateIntervalMs * 0.75), minIntervalMs)
+        else:
+            intervalMs = self._updateIntervalMs
+
+        # Re-register, the registration result will request the entry list and track data again
+        if intervalMs != self._updateIntervalMs:
+            self._updateIntervalMs = intervalMs
+            self._request_disconnection()
+            self._request_connection()
+
     def _run(self):
         try:
             while not self._stopSignal:
-                try:
-                    messageTypeData = self._reader.read(1, timeout=0.1)
-                except (ConnectionResetError, EndOfStreamError):
-                    self._update_connection_state("lost")
-                    break
-                if messageTypeData is None:
+                for key, _ in self._selector.select(max(self._deadline - time.monotonic(), 0)):
+                    key.data()
+                    if self._stopSignal:
+                        break
+                if self._adaptiveUpdateIntervalMs is not None:
+                    self._adapt_update_interval()
+
+                # Check if the server went silent
+                if self._stopSignal or time.monotonic() < self._deadline:
                     continue
-                (messageType,) = struct.unpack("B", messageTypeData)
-                self._receiveMethods[messageType]()
+                if self._connectionState == "established":
+                    self._update_connection_state("lost")
+                    if not self._reconnect:
+                        break
+                    self._reconnect_socket()
+                elif self._reconnect:
+                    self._reconnect_socket()
+                else:
+                    # Keep waiting for a registration result, asking again with backoff
+                    self._register()
         finally:
             try:
                 self._request_disconnection()
             except:
                 pass
-        self._reader.stop()
-        self._reader = None
-        self._socket.close()
-        self._socket = None
+            self._close_socket()
+            self._selector.close()
+            self._selector = None
+            self._wakeupReceiver.close()
+            self._wakeupSender.close()
 
     @property
     def isAlive(self):
@@ -412,22 +992,83 @@ class AccClient(object):
         commandPassword: str = "",
         displayName: str = "Python ACCAPI",
         updateIntervalMs: int = 100,
+        livenessTimeoutMs: int = None,
+        reconnect: bool = True,
+        reconnectDelayMs: int = 250,
+        reconnectMaxDelayMs: int = 5000,
+        adaptiveUpdateIntervalMs: tuple = None,
+        deduplicate: bool = False,
+        timestamps: bool = False,
+        conflate: bool = False,
+        receiveBufferSize: int = None,
     ):
+        """
+        Registers with the ACC broadcasting server and starts receiving updates.
+
+        Args:
+            livenessTimeoutMs (int): The connection is considered lost when nothing is received
+                for this long. Defaults to 10 update intervals, but no less than 2 seconds.
+            reconnect (bool): Register again automatically when the connection is lost, otherwise
+                the client stops. Registration is retried until answered either way.
+            reconnectDelayMs (int): How long to wait for a registration result before retrying.
+                Doubles on each consecutive attempt.
+            reconnectMaxDelayMs (int): Upper bound for the retry delay.
+            adaptiveUpdateIntervalMs (tuple): Minimum and maximum update interval. When given, the
+                update interval is adjusted within these bounds according to how long it takes to
+                decode and dispatch updates.
+            deduplicate (bool): Skip decoding realtime car updates, entry lists, entry list cars and
+                track data identical to the previous ones for the same car or connection. Those
+                are only delivered again to subscribers that asked for duplicates.
+            timestamps (bool): Attach receive, decode and dispatch times to events. The receive
+                time comes from the kernel when supported, otherwise from a monotonic clock when
+                the datagram is read.
+            conflate (bool): When a backlog builds up, drain it and only decode the latest
+                realtime update and the latest realtime car update of each car. Other messages are
+                never dropped. Skipped updates are counted in conflatedCount.
+            receiveBufferSize (int): Size of the socket receive buffer in bytes, or None for the
+                system default.
+        """
         if self.isAlive:
             raise ValueError("Must be stopped")
         self._update_connection_state("connecting")
         self._server = (url, port)
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.settimeout(1)
-        self._reader = ThreadedSocketReader(self._socket)
-        self._thread = Thread(target=self._run)
-        self._stopSignal = False
-        self._thread.start()
+        self._selector = selectors.DefaultSelector()
+        self._wakeupReceiver, self._wakeupSender = socket.socketpair()
+        self._wakeupReceiver.setblocking(False)
+        self._wakeupSender.setblocking(False)
+        self._selector.register(self._wakeupReceiver, selectors.EVENT_READ, self._read_wakeup)
+        self._commands.clear()
+        self._timestamps = timestamps
+        self._conflate = conflate
+        self._conflatedCount = 0
+        self._receiveBufferSize = receiveBufferSize
+        self._open_socket()
         self._connectionId = None
         self._writable = False
         self._displayName = displayName
+        self._password = password
+        self._commandPassword = commandPassword
         self._updateIntervalMs = updateIntervalMs
-        self._request_connection(password, commandPassword)
+        self._adaptiveUpdateIntervalMs = adaptiveUpdateIntervalMs
+        self._deduplicate = deduplicate
+        self._duplicates.clear()
+        self._duplicateCount = 0
+        self._reset_load_window()
+        if livenessTimeoutMs is None:
+            slowestIntervalMs = updateIntervalMs
+            if adaptiveUpdateIntervalMs is not None:
+                slowestIntervalMs = max(updateIntervalMs, adaptiveUpdateIntervalMs[1])
+            livenessTimeoutMs = max(10 * slowestIntervalMs, 2000)
+        self._livenessTimeoutMs = livenessTimeoutMs
+        self._reconnect = reconnect
+        self._reconnectDelayMs = reconnectDelayMs
+        self._reconnectMaxDelayMs = reconnectMaxDelayMs
+        self._reconnectAttempts = 0
+        self._deadline = time.monotonic() + reconnectDelayMs / 1000
+        self._thread = Thread(target=self._run)
+        self._stopSignal = False
+        self._thread.start()
+        self._post(self._register)
 
     def stop(self):
         if not self.isAlive:
@@ -436,7 +1077,10 @@ class AccClient(object):
 
     def _stop(self, state: str = "disconnected"):
         self._stopSignal = True
-        if self._thread is not None:
+
+        # When stopping from within the thread, it will exit on its own once the handler returns
+        if self._thread is not None and self._thread is not current_thread():
+            self._wake()
             self._thread.join()
             self._thread = None
         self._update_connection_state(state)
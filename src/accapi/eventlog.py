@@ -0,0 +1,128 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from threading import Lock
+
+__all__ = ["BroadcastingEventLog"]
+
+
+class BroadcastingEventLog(object):
+    """
+    Keeps the most recent broadcasting events, indexed by type, car index and time, so that queries
+    don't have to go through the whole log.
+
+    Args:
+        size (int): Maximum number of events, the oldest ones are dropped first.
+    """
+
+    def __init__(self, size: int = 1000):
+        if size < 1:
+            raise ValueError("Size must be at least 1")
+        self._size = size
+        self._lock = Lock()
+        self._sequence = 0
+
+        # Entries are (timeMs, sequence, event) so that indices sort by time, then arrival
+        self._arrivals = deque()
+        self._all = []
+        self._byType = {}
+        self._byCar = {}
+        self._byTypeAndCar = {}
+
+    def __len__(self):
+        return len(self._arrivals)
+
+    @property
+    def size(self):
+        return self._size
+
+    def _indices(self, event):
+        return (
+            self._all,
+            self._byType.setdefault(event.type, []),
+            self._byCar.setdefault(event.carIndex, []),
+            self._byTypeAndCar.setdefault((event.type, event.carIndex), []),
+        )
+
+    def _index(self, eventType, carIndex):
+        if eventType is None and carIndex is None:
+            return self._all
+        if carIndex is None:
+            return self._byType.get(eventType, [])
+        if eventType is None:
+            return self._byCar.get(carIndex, [])
+        return self._byTypeAndCar.get((eventType, carIndex), [])
+
+    def add(self, event):
+        """
+        Adds an event, dropping the oldest one if the log is full.
+
+        Args:
+            event (BroadcastingEvent): The event to add.
+        """
+        with self._lock:
+            if len(self._arrivals) >= self._size:
+                self._remove(self._arrivals.popleft())
+            entry = (event.timeMs, self._sequence, event)
+            self._sequence += 1
+            self._arrivals.append(entry)
+            for index in self._indices(event):
+                insort(index, entry)
+
+    def _remove(self, entry):
+        event = entry[2]
+        for mapping, key in (
+            (self._byType, event.type),
+            (self._byCar, event.carIndex),
+            (self._byTypeAndCar, (event.type, event.carIndex)),
+        ):
+            index = mapping[key]
+            del index[bisect_left(index, entry)]
+            if not index:
+                del mapping[key]
+        del self._all[bisect_left(self._all, entry)]
+
+    def clear(self):
+        with self._lock:
+            self._arrivals.clear()
+            self._all.clear()
+            self._byType.clear()
+            self._byCar.clear()
+            self._byTypeAndCar.clear()
+
+    def query(
+        self, eventType: str = None, carIndex: int = None, startMs: int = None, endMs: int = None
+    ):
+        """
+        Finds events matching all the given criteria.
+
+        Args:
+            eventType (str): Type of event, such as "Accident", or None for any type.
+            carIndex (int): Car involved, or None for any car.
+            startMs (int): Earliest session time, inclusive, or None.
+            endMs (int): Latest session time, inclusive, or None.
+
+        Returns:
+            list: Matching events, ordered by time.
+        """
+        with self._lock:
+            index = self._index(eventType, carIndex)
+            start = 0 if startMs is None else bisect_left(index, (startMs,))
+            end = len(index) if endMs is None else bisect_right(index, (endMs, float("inf")))
+            return [entry[2] for entry in index[start:end]]
+
+    def latest(self, count: int = 1, eventType: str = None, carIndex: int = None):
+        """
+        Finds the most recent events matching all the given criteria.
+
+        Args:
+            count (int): Maximum number of events.
+            eventType (str): Type of event, such as "Accident", or None for any type.
+            carIndex (int): Car involved, or None for any car.
+
+        Returns:
+            list: Matching events, ordered by time.
+        """
+        if count < 1:
+            return []
+        with self._lock:
+            return [entry[2] for entry in self._index(eventType, carIndex)[-count:]]
@@ -0,0 +1,106 @@
+from collections import deque
+from threading import Lock
+import logging
+
+__all__ = ["LatencyRecorder"]
+
+
+class LatencyRecorder(object):
+    """
+    Collects the latency added by the client to timestamped events and reports percentiles. The
+    client must be started with timestamps enabled.
+
+    Each stage is measured from the time the datagram was received:
+        decode: The content has been decoded.
+        dispatch: Dispatching to callbacks started.
+        delivery: The recorder's own callback was called.
+
+    Args:
+        size (int): Number of most recent samples kept per stage.
+    """
+
+    stages = ("decode", "dispatch", "delivery")
+
+    def __init__(self, size: int = 10000):
+        self._lock = Lock()
+        self._samples = {stage: deque(maxlen=size) for stage in self.stages}
+
+    def attach(self, client):
+        """
+        Subscribes to all the content updates of a client.
+
+        Args:
+            client (AccClient): The client to measure.
+        """
+        for observable in (
+            client.onTrackDataUpdate,
+            client.onEntryListCarUpdate,
+            client.onRealtimeUpdate,
+            client.onRealtimeCarUpdate,
+            client.onBroadcastingEvent,
+        ):
+            observable.subscribe(self.record)
+
+    def record(self, event):
+        """
+        Records the latency of an event, ignoring events without timestamps.
+
+        Args:
+            event (Event): A timestamped event.
+        """
+        if event.receivedNs is None:
+            return
+        deliveredNs = event.source.clock()
+        with self._lock:
+            self._samples["decode"].append(event.decodedNs - event.receivedNs)
+            self._samples["dispatch"].append(event.dispatchedNs - event.receivedNs)
+            self._samples["delivery"].append(deliveredNs - event.receivedNs)
+
+    def reset(self):
+        with self._lock:
+            for samples in self._samples.values():
+                samples.clear()
+
+    def percentiles(self, percents: tuple = (50, 90, 99, 100)):
+        """
+        Args:
+            percents (tuple): Percentiles to compute, between 0 and 100.
+
+        Returns:
+            dict: For each stage, a dictionary of latencies in milliseconds by percentile, or None
+                without samples.
+        """
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        out = {}
+        for stage, values in samples.items():
+            if not values:
+                out[stage] = None
+                continue
+            out[stage] = {
+                p: values[min(max(round(p / 100 * len(values)) - 1, 0), len(values) - 1)] / 1e6
+                for p in percents
+            }
+        return out
+
+    def log(self, logger: logging.Logger = None, level: int = logging.INFO, percents=(50, 90, 99)):
+        """
+        Logs the percentiles of each stage.
+
+        Args:
+            logger (logging.Logger): Defaults to the logger of this module.
+            level (int): Logging level.
+            percents (tuple): Percentiles to log.
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        for stage, values in self.percentiles(percents).items():
+            if values is None:
+                logger.log(level, "%s: no samples", stage)
+            else:
+                logger.log(
+                    level,
+                    "%s: %s",
+                    stage,
+                    ", ".join(f"p{p} {ms:.3f} ms" for p, ms in values.items()),
+                )
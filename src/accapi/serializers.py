@@ -0,0 +1,300 @@
+import json
+import struct
+
+from .structs import (
+    RegistrationResult,
+    RealtimeUpdate,
+    Lap,
+    RealtimeCarUpdate,
+    EntryList,
+    Driver,
+    EntryListCar,
+    TrackData,
+    BroadcastingEvent,
+)
+
+__all__ = ["Serializer", "DeltaEncoder", "pack"]
+
+
+# Public fields of each struct in order, nested structs are given by class, lists of structs by a
+# single element list
+LAYOUTS = {
+    RegistrationResult: ("connectionId", "success", "writable", "errorMessage"),
+    RealtimeUpdate: (
+        "eventIndex",
+        "sessionIndex",
+        "sessionType",
+        "sessionPhase",
+        "sessionTimeMs",
+        "sessionEndTimeMs",
+        "focusedCarIndex",
+        "activeCameraSet",
+        "activeCamera",
+        "currentHudPage",
+        "isReplayPlaying",
+        "replaySessionTime",
+        "replayRemainingTime",
+        "timeOfDayMs",
+        "ambientTemp",
+        "trackTemp",
+        "clouds",
+        "rainLevel",
+        "wetness",
+        ("bestSessionLap", Lap),
+    ),
+    Lap: (
+        "lapTimeMs",
+        "carIndex",
+        "driverIndex",
+        "splits",
+        "isInvalid",
+        "isValidForBest",
+        "isOutlap",
+        "isInlap",
+        "type",
+    ),
+    RealtimeCarUpdate: (
+        "carIndex",
+        "driverIndex",
+        "driverCount",
+        "gear",
+        "worldPosX",
+        "worldPosY",
+        "yaw",
+        "location",
+        "kmh",
+        "position",
+        "cupPosition",
+        "trackPosition",
+        "splinePosition",
+        "laps",
+        "delta",
+        ("bestSessionLap", Lap),
+        ("lastLap", Lap),
+        ("currentLap", Lap),
+    ),
+    EntryList: ("connectionId", "carIndices"),
+    Driver: ("firstName", "lastName", "shortName", "category", "nationality"),
+    EntryListCar: (
+        "carIndex",
+        "modelType",
+        "teamName",
+        "raceNumber",
+        "cupCategory",
+        "currentDriverIndex",
+        "nationality",
+        ("drivers", [Driver]),
+    ),
+    TrackData: ("connectionId", "trackName", "trackId", "trackMeters", "cameraSets", "hudPages"),
+    BroadcastingEvent: ("type", "message", "timeMs", "carIndex"),
+}
+
+
+class Serializer(object):
+    """
+    Converts structs of a given class to plain values. The conversion functions are generated once
+    from the class layout, skipping private attributes such as leftovers.
+
+    Args:
+        cls (type): One of the classes from accapi.structs.
+        fields (list): Names of the fields to include, in order, or None for all of them.
+
+    Attributes:
+        fields (tuple): Names of the included fields, which is also the order of the values.
+        to_dict (callable): Converts a struct to a dictionary of field names and values, nested
+            structs included.
+        to_values (callable): Converts a struct to a list of values in the order of the fields,
+            nested structs included.
+    """
+
+    def __init__(self, cls, fields: list = None):
+        layout = {}
+        for field in LAYOUTS[cls]:
+            if isinstance(field, tuple):
+                layout[field[0]] = field[1]
+            else:
+                layout[field] = None
+        if fields is None:
+            fields = layout.keys()
+        unknown = [f for f in fields if f not in layout]
+        if unknown:
+            raise ValueError(f"Unknown fields for {cls.__name__}: {', '.join(unknown)}")
+        self.cls = cls
+        self.fields = tuple(fields)
+
+        # Generate the conversion functions, nested structs use their own serializer
+        namespace = {}
+        dictItems = []
+        valueItems = []
+        for name in self.fields:
+            nested = layout[name]
+            if nested is None:
+                dictItems.append(f"{name!r}: o.{name}")
+                valueItems.append(f"o.{name}")
+                continue
+            if isinstance(nested, list):
+                serializer = Serializer(nested[0])
+                dictExpr = f"[{name}_dict(v) for v in o.{name}]"
+                valueExpr = f"[{name}_values(v) for v in o.{name}]"
+            else:
+                serializer = Serializer(nested)
+                dictExpr = f"{name}_dict(o.{name})"
+                valueExpr = f"{name}_values(o.{name})"
+            namespace[f"{name}_dict"] = serializer.to_dict
+            namespace[f"{name}_values"] = serializer.to_values
+            dictItems.append(f"{name!r}: {dictExpr}")
+            valueItems.append(valueExpr)
+        source = (
+            f"def to_dict(o):\n    return {{{', '.join(dictItems)}}}\n"
+            f"def to_values(o):\n    return [{', '.join(valueItems)}]\n"
+        )
+        exec(compile(source, f"<{cls.__name__} serializer>", "exec"), namespace)
+        self.to_dict = namespace["to_dict"]
+        self.to_values = namespace["to_values"]
+
+    def to_json(self, obj) -> str:
+        """
+        Converts a struct to a compact JSON object.
+        """
+        return json.dumps(self.to_dict(obj), separators=(",", ":"))
+
+    def to_bytes(self, obj) -> bytes:
+        """
+        Converts a struct to a MessagePack array of values in the order of the fields.
+        """
+        return pack(self.to_values(obj))
+
+
+class DeltaEncoder(object):
+    """
+    Keeps the previous frame of each entity, such as each car, and only returns the fields that
+    changed since then.
+
+    Args:
+        serializer (Serializer): Used to convert the structs.
+        key (str): Field identifying the entity, always included in the output.
+    """
+
+    def __init__(self, serializer: Serializer, key: str = "carIndex"):
+        if key not in serializer.fields:
+            raise ValueError(f"Key field '{key}' is not serialized")
+        self._serializer = serializer
+        self._key = key
+        self._previous = {}
+
+    def encode(self, obj) -> dict:
+        """
+        Converts a struct to a dictionary containing the key and the fields that changed since the
+        previous frame of the same entity. The first frame of an entity is complete.
+        """
+        current = self._serializer.to_dict(obj)
+        key = current[self._key]
+        previous = self._previous.get(key)
+        self._previous[key] = current
+        if previous is None:
+            return current
+        delta = {k: v for k, v in current.items() if previous[k] != v}
+        delta[self._key] = key
+        return delta
+
+    def reset(self, key=None):
+        """
+        Forgets the previous frames so that the next ones are complete.
+
+        Args:
+            key: Only forget the given entity, or None for all of them.
+        """
+        if key is None:
+            self._previous.clear()
+        else:
+            self._previous.pop(key, None)
+
+
+_float = struct.Struct(">Bf")
+_double = struct.Struct(">Bd")
+
+
+def pack(value) -> bytes:
+    """
+    Encodes plain values to MessagePack. Supports None, booleans, integers, floats, strings, lists,
+    tuples and dictionaries. Floats use single precision when it is lossless, which is the case
+    for values coming straight from the ACC protocol.
+    """
+    out = bytearray()
+    _pack(value, out)
+    return bytes(out)
+
+
+def _pack(value, out: bytearray):
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -0x20 <= value < 0:
+            out.append(value & 0xFF)
+        elif 0 <= value <= 0xFF:
+            out += struct.pack(">BB", 0xCC, value)
+        elif 0 <= value <= 0xFFFF:
+            out += struct.pack(">BH", 0xCD, value)
+        elif 0 <= value <= 0xFFFFFFFF:
+            out += struct.pack(">BI", 0xCE, value)
+        elif 0 <= value:
+            out += struct.pack(">BQ", 0xCF, value)
+        elif -0x80 <= value:
+            out += struct.pack(">Bb", 0xD0, value)
+        elif -0x8000 <= value:
+            out += struct.pack(">Bh", 0xD1, value)
+        elif -0x80000000 <= value:
+            out += struct.pack(">Bi", 0xD2, value)
+        else:
+            out += struct.pack(">Bq", 0xD3, value)
+    elif isinstance(value, float):
+        try:
+            packed = _float.pack(0xCA, value)
+        except OverflowError:
+            # Out of float32 range
+            packed = None
+        if packed is not None and _float.unpack(packed)[1] == value:
+            out += packed
+        else:
+            out += _double.pack(0xCB, value)
+    elif isinstance(value, str):
+        encoded = value.encode("utf8")
+        length = len(encoded)
+        if length < 0x20:
+            out.append(0xA0 | length)
+        elif length <= 0xFF:
+            out += struct.pack(">BB", 0xD9, length)
+        elif length <= 0xFFFF:
+            out += struct.pack(">BH", 0xDA, length)
+        else:
+            out += struct.pack(">BI", 0xDB, length)
+        out += encoded
+    elif isinstance(value, (list, tuple)):
+        length = len(value)
+        if length < 0x10:
+            out.append(0x90 | length)
+        elif length <= 0xFFFF:
+            out += struct.pack(">BH", 0xDC, length)
+        else:
+            out += struct.pack(">BI", 0xDD, length)
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, dict):
+        length = len(value)
+        if length < 0x10:
+            out.append(0x80 | length)
+        elif length <= 0xFFFF:
+            out += struct.pack(">BH", 0xDE, length)
+        else:
+            out += struct.pack(">BI", 0xDF, length)
+        for k, v in value.items():
+            _pack(k, out)
+            _pack(v, out)
+    else:
+        raise TypeError(f"Cannot pack {value.__class__.__name__}")
@@ -0,0 +1,400 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import json
+import math
+import os
+import tempfile
+
+__all__ = ["TrackMap", "TrackMapper"]
+
+
+class TrackMap(object):
+    """
+    Lookup table of a track centreline, indexed by spline position. Each of the bins holds the
+    mean world position of the samples received within it.
+
+    The map is learned until every bin has enough samples, then it is complete and stops learning.
+    Positions are available for learned bins right away, conversions to metres and from world
+    positions once the map is complete. All lookups take constant time.
+
+    Args:
+        trackId (int): Identifies the track, for caching.
+        trackMeters (int): Track length. When given, distances are scaled to match it.
+        resolution (int): Number of bins.
+        minSamples (int): Samples needed in each bin for the map to be complete.
+        cellSize (float): Size in metres of the grid cells mapping world positions to bins.
+        maxDistance (float): World positions further away from the centreline have no spline
+            position.
+    """
+
+    def __init__(
+        self,
+        trackId: int = None,
+        trackMeters: int = None,
+        resolution: int = 1000,
+        minSamples: int = 5,
+        cellSize: float = 5.0,
+        maxDistance: float = 50.0,
+    ):
+        self.trackId = trackId
+        self.trackMeters = trackMeters
+        self._resolution = resolution
+        self._minSamples = minSamples
+        self._cellSize = cellSize
+        self._maxDistance = maxDistance
+        self._sumX = [0.0] * resolution
+        self._sumY = [0.0] * resolution
+        self._counts = [0] * resolution
+        self._learnedBins = 0
+        self._x = [None] * resolution
+        self._y = [None] * resolution
+        self._complete = False
+
+        # Built once complete
+        self._cumulative = None
+        self._lengths = None
+        self._origin = 0
+        self._scale = 1
+        self._cells = None
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @property
+    def complete(self):
+        return self._complete
+
+    @property
+    def coverage(self):
+        """
+        Fraction of the bins that have enough samples.
+        """
+        return self._learnedBins / self._resolution
+
+    @property
+    def length(self):
+        """
+        Length of the centreline in metres, or None if the map is incomplete.
+        """
+        if not self._complete:
+            return None
+        return (self._cumulative[-1] + self._lengths[-1]) * self._scale
+
+    def add_sample(self, splinePosition: float, x: float, y: float):
+        """
+        Learns from the world position of a car on track. Ignored once the map is complete.
+        """
+        if self._complete or not 0 <= splinePosition <= 1:
+            return
+        i = min(int(splinePosition * self._resolution), self._resolution - 1)
+        self._sumX[i] += x
+        self._sumY[i] += y
+        self._counts[i] += 1
+        count = self._counts[i]
+        self._x[i] = self._sumX[i] / count
+        self._y[i] = self._sumY[i] / count
+        if count == self._minSamples:
+            self._learnedBins += 1
+            if self._learnedBins == self._resolution:
+                self._build()
+
+    def _build(self):
+        """
+        Freezes the map and builds the distance and grid tables.
+        """
+        n = self._resolution
+        self._complete = True
+
+        # Distance along the centreline, from the centre of the first bin
+        self._lengths = [
+            math.hypot(self._x[(i + 1) % n] - self._x[i], self._y[(i + 1) % n] - self._y[i])
+            for i in range(n)
+        ]
+        self._cumulative = [0.0] * n
+        for i in range(1, n):
+            self._cumulative[i] = self._cumulative[i - 1] + self._lengths[i - 1]
+        self._scale = 1
+        self._origin = self._raw_meters(0)
+        if self.trackMeters:
+            self._scale = self.trackMeters / (self._cumulative[-1] + self._lengths[-1])
+
+        # Rasterize the centreline, then spread each bin to the cells around it
+        size = self._cellSize
+        cells = {}
+        queue = deque()
+        for i in range(n):
+            j = (i + 1) % n
+            steps = max(int(self._lengths[i] / size * 2), 1)
+            for step in range(steps):
+                t = step / steps
+                cell = (
+                    math.floor((self._x[i] + t * (self._x[j] - self._x[i])) / size),
+                    math.floor((self._y[i] + t * (self._y[j] - self._y[i])) / size),
+                )
+                if cell not in cells:
+                    cells[cell] = i if t < 0.5 else j
+                    queue.append((cell, 0))
+        depth = math.ceil(self._maxDistance / size)
+        while queue:
+            (cx, cy), d = queue.popleft()
+            if d >= depth:
+                continue
+            for neighbour in ((cx + 1, cy), (cx - 1, cy), (cx, cy + 1), (cx, cy - 1)):
+                if neighbour not in cells:
+                    cells[neighbour] = cells[(cx, cy)]
+                    queue.append((neighbour, d + 1))
+        self._cells = cells
+
+    def position(self, splinePosition: float):
+        """
+        Returns:
+            tuple: World position (x, y) of the centreline at a spline position, or None if not
+                learned yet.
+        """
+        n = self._resolution
+        u = (splinePosition % 1) * n - 0.5
+        i = math.floor(u)
+        f = u - i
+        i %= n
+        j = (i + 1) % n
+        if self._x[i] is None or self._x[j] is None:
+            return None
+        return (
+            self._x[i] + f * (self._x[j] - self._x[i]),
+            self._y[i] + f * (self._y[j] - self._y[i]),
+        )
+
+    def _raw_meters(self, splinePosition):
+        u = (splinePosition % 1) * self._resolution - 0.5
+        i = math.floor(u)
+        f = u - i
+        i %= self._resolution
+        return self._cumulative[i] + f * self._lengths[i]
+
+    def meters(self, splinePosition: float):
+        """
+        Returns:
+            float: Distance in metres from the start line to a spline position, or None if the map
+                is incomplete.
+        """
+        if not self._complete:
+            return None
+        total = self._cumulative[-1] + self._lengths[-1]
+        return ((self._raw_meters(splinePosition) - self._origin) % total) * self._scale
+
+    def distance(self, fromSplinePosition: float, toSplinePosition: float):
+        """
+        Returns:
+            float: Distance in metres driving forward from a spline position to another, such as
+                the gap to the car ahead, or None if the map is incomplete.
+        """
+        if not self._complete:
+            return None
+        return (self.meters(toSplinePosition) - self.meters(fromSplinePosition)) % self.length
+
+    def spline_position(self, x: float, y: float):
+        """
+        Returns:
+            float: Spline position of the centreline point nearest to a world position, or None if
+                the map is incomplete or the position is too far from the track.
+        """
+        if not self._complete:
+            return None
+        i = self._cells.get((math.floor(x / self._cellSize), math.floor(y / self._cellSize)))
+        if i is None:
+            return None
+
+        # Project on the segments before and after the centre of the bin
+        n = self._resolution
+        best = None
+        for start in ((i - 1) % n, i):
+            end = (start + 1) % n
+            dx = self._x[end] - self._x[start]
+            dy = self._y[end] - self._y[start]
+            lengthSquared = dx * dx + dy * dy
+            t = 0
+            if lengthSquared > 0:
+                t = ((x - self._x[start]) * dx + (y - self._y[start]) * dy) / lengthSquared
+                t = min(max(t, 0), 1)
+            distance = math.hypot(self._x[start] + t * dx - x, self._y[start] + t * dy - y)
+            if best is None or distance < best[0]:
+                best = (distance, (start + 0.5 + t) / n % 1)
+        return best[1]
+
+    def to_dict(self):
+        return {
+            "trackId": self.trackId,
+            "trackMeters": self.trackMeters,
+            "resolution": self._resolution,
+            "minSamples": self._minSamples,
+            "sumX": self._sumX,
+            "sumY": self._sumY,
+            "counts": self._counts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, **kwargs):
+        """
+        Args:
+            data (dict): As returned by to_dict.
+            kwargs: Other TrackMap arguments, the resolution and minimum samples come from the
+                data.
+        """
+        kwargs.update(resolution=data["resolution"], minSamples=data["minSamples"])
+        trackMap = cls(data["trackId"], data["trackMeters"], **kwargs)
+        for i, (sumX, sumY, count) in enumerate(zip(data["sumX"], data["sumY"], data["counts"])):
+            if count == 0:
+                continue
+            trackMap._sumX[i] = sumX
+            trackMap._sumY[i] = sumY
+            trackMap._counts[i] = count
+            trackMap._x[i] = sumX / count
+            trackMap._y[i] = sumY / count
+            if count >= trackMap._minSamples:
+                trackMap._learnedBins += 1
+        if trackMap._learnedBins == trackMap._resolution:
+            trackMap._build()
+        return trackMap
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str, **kwargs):
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f), **kwargs)
+
+
+class TrackMapper(object):
+    """
+    Learns the map of the current track from the realtime car updates of a client. Maps are cached
+    on disk by track ID, so a track is only learned once. The cache is read and written in order on
+    a worker thread, so that file I/O doesn't hold up the client thread.
+
+    Args:
+        cacheDir (str): Directory where maps are saved, or None to not cache them.
+        kwargs: Arguments of new TrackMap instances.
+    """
+
+    def __init__(self, cacheDir: str = None, **kwargs):
+        self._cacheDir = cacheDir
+        self._kwargs = kwargs
+        self._lock = Lock()
+        self._trackId = None
+        self._map = None
+        self._saved = False
+        self._executor = ThreadPoolExecutor(1)
+
+    @property
+    def map(self):
+        """
+        The map of the current track, or None before track data is received and while the map is
+        being loaded.
+        """
+        return self._map
+
+    def attach(self, client):
+        """
+        Subscribes to the track data and realtime car updates of a client.
+
+        Args:
+            client (AccClient): The client to learn from.
+        """
+        client.onTrackDataUpdate.subscribe(self.on_track_data_update)
+        client.onRealtimeCarUpdate.subscribe(self.on_realtime_car_update)
+        client.onConnectionStateChange.subscribe(self.on_connection_state_change)
+
+    def _path(self, trackId):
+        return os.path.join(self._cacheDir, f"{trackId}.json")
+
+    def _snapshot(self):
+        with self._lock:
+            if self._cacheDir is None or self._map is None:
+                return None
+            data = self._map.to_dict()
+            self._saved = self._map.complete
+
+        # Copied on the calling thread, as the map keeps learning while it is written
+        for key in ("sumX", "sumY", "counts"):
+            data[key] = list(data[key])
+        return data
+
+    def _write(self, data):
+        # Replaced at once so that readers never see a partially written map
+        os.makedirs(self._cacheDir, exist_ok=True)
+        fd, temporaryPath = tempfile.mkstemp(suffix=".tmp", dir=self._cacheDir)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(temporaryPath, self._path(data["trackId"]))
+        except BaseException:
+            os.remove(temporaryPath)
+            raise
+
+    def _load(self, trackId, trackMeters):
+        trackMap = None
+        if self._cacheDir is not None and os.path.exists(self._path(trackId)):
+            try:
+                trackMap = TrackMap.load(self._path(trackId), **self._kwargs)
+            except (OSError, ValueError, KeyError):
+                trackMap = None
+        if trackMap is None:
+            trackMap = TrackMap(trackId, trackMeters, **self._kwargs)
+        with self._lock:
+            if self._trackId == trackId:
+                self._map = trackMap
+                self._saved = trackMap.complete
+
+    def save(self):
+        """
+        Saves the current map to the cache, complete or not, and waits until it is written.
+        """
+        future = self.save_later()
+        if future is not None:
+            future.result()
+
+    def save_later(self):
+        """
+        Saves the current map to the cache on the worker thread.
+
+        Returns:
+            Future: Done once the map is written, or None if there is nothing to save.
+        """
+        data = self._snapshot()
+        if data is None:
+            return None
+        return self._executor.submit(self._write, data)
+
+    def close(self):
+        """
+        Waits for pending cache reads and writes, then stops the worker thread. Stop the client
+        first, as the mapper can't save anymore.
+        """
+        self._executor.shutdown(wait=True)
+
+    def on_track_data_update(self, event):
+        data = event.content
+        if data.trackId == self._trackId:
+            return
+        self.save_later()
+        with self._lock:
+            self._trackId = data.trackId
+            self._map = None
+        self._executor.submit(self._load, data.trackId, data.trackMeters)
+
+    def on_realtime_car_update(self, event):
+        trackMap = self._map
+        if trackMap is None or trackMap.complete:
+            return
+        update = event.content
+        if update.location == "Track":
+            trackMap.add_sample(update.splinePosition, update.worldPosX, update.worldPosY)
+            if trackMap.complete and not self._saved:
+                self.save_later()
+
+    def on_connection_state_change(self, event):
+        if event.content not in ("connecting", "established"):
+            self.save_later()